@@ -13,6 +13,9 @@ setup(
     packages=["weibo_downloader"],
     keywords=["weibo", "downloader", "scraper", "crawler", "video", "image"],
     test_suite="tests",
+    entry_points={
+        "console_scripts": ["weibo-downloader=weibo_downloader.cli:main"],
+    },
     install_requires=[
         "requests",
         "selenium",
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from weibo_downloader import DetailCache, WeiboDownloader
+
+
+class TestDetailCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "cache.sqlite3")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_persists_between_instances(self):
+        """Test that entries survive reopening the cache file."""
+        cache = DetailCache(self.path)
+        cache.set("detail", "abc", {"url": "https://m.weibo.cn/status/1"})
+        cache.close()
+        cache = DetailCache(self.path)
+        self.assertEqual(
+            cache.get("detail", "abc"), {"url": "https://m.weibo.cn/status/1"}
+        )
+        self.assertIsNone(cache.get("video", "abc"))
+
+    def test_expired_entries_are_dropped(self):
+        """Test that entries are not returned after their TTL."""
+        cache = DetailCache(self.path, ttl=60)
+        cache.set("uid", "dummy_user", 123456)
+        cache.set("video", "abc", {"video": "link"}, ttl=0.01)
+        time.sleep(0.05)
+        self.assertEqual(cache.get("uid", "dummy_user"), 123456)
+        self.assertIsNone(cache.get("video", "abc"))
+        self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_is_evicted(self):
+        """Test that the least recently used entry is evicted first."""
+        cache = DetailCache(self.path, max_entries=2)
+        cache.set("detail", "a", 1)
+        cache.set("detail", "b", 2)
+        cache.get("detail", "a")
+        cache.set("detail", "c", 3)
+        self.assertEqual(cache.get("detail", "a"), 1)
+        self.assertIsNone(cache.get("detail", "b"))
+        self.assertEqual(cache.get("detail", "c"), 3)
+
+    @patch("requests.get")
+    def test_uid_is_resolved_from_cache(self, mock_get):
+        """Test that a cached username does not hit the network."""
+        cache = DetailCache(self.path)
+        cache.set("uid", "dummy_user", 123456)
+        downloader = WeiboDownloader(username="dummy_user", cache=cache)
+        self.assertEqual(downloader.uid, 123456)
+        mock_get.assert_not_called()
+
+    def make_post(self, **attrs):
+        post = {
+            "username": "",
+            "uid": 123456,
+            "text": "truncated text ...全文",
+            "time": "2023-01-01 00:00:00",
+            "thumbnail_images": [],
+            "images": ["https://wx1.sinaimg.cn/large/abc.jpg"],
+            "video": None,
+            "links": [],
+            "url": None,
+            "tracking_params": {"is_text_truncated": True, "hash": "card"},
+        }
+        post.update(attrs)
+        return post
+
+    def test_cache_hit_allows_for_relative_times(self):
+        """Test that a time parsed differently on another run still hits."""
+        downloader = WeiboDownloader(uid=123456, cache=DetailCache(self.path))
+        downloader.set_cached_details("detail", self.make_post(), {"text": "full"})
+        self.assertEqual(
+            downloader.get_cached_details(
+                "detail", self.make_post(time="2023-01-01 20:00:00")
+            ),
+            {"text": "full"},
+        )
+
+    def test_same_text_posts_from_other_dates_do_not_share_details(self):
+        """Test that identical reposts from different dates are told apart."""
+        downloader = WeiboDownloader(uid=123456, cache=DetailCache(self.path))
+        first, second = (
+            self.make_post(text="转发微博", images=[], time=post_time)
+            for post_time in ("2023-01-01 00:00:00", "2023-03-01 00:00:00")
+        )
+        self.assertEqual(
+            downloader.generate_cache_key(first), downloader.generate_cache_key(second)
+        )
+        with patch.object(downloader, "extract_post_data_from_expand") as mock_expand:
+            for post, url in ((first, "/status/101"), (second, "/status/102")):
+                mock_expand.return_value = self.make_post(
+                    text="转发微博", images=[], url="https://m.weibo.cn" + url
+                )
+                downloader.get_urls([post])
+        self.assertEqual(mock_expand.call_count, 2)
+        self.assertEqual(first["url"], "https://m.weibo.cn/status/101")
+        self.assertEqual(second["url"], "https://m.weibo.cn/status/102")
+
+    def test_expanded_details_are_cached(self):
+        """Test that only text, url and links of expanded posts are cached."""
+        cache = DetailCache(self.path)
+        downloader = WeiboDownloader(uid=123456, cache=cache)
+        post = self.make_post()
+        expand_post = self.make_post(
+            text="full text",
+            time="2023-01-01 00:05:00",
+            url="https://m.weibo.cn/status/101",
+            tracking_params={"is_text_truncated": False, "hash": "expanded"},
+        )
+        with patch.object(
+            downloader, "extract_post_data_from_expand", return_value=expand_post
+        ):
+            downloader.get_urls([post])
+        details = {"text": "full text", "url": expand_post["url"], "links": []}
+        self.assertEqual(
+            cache.get("detail", downloader.generate_cache_key(self.make_post())),
+            {"time": "2023-01-01 00:00:00", "details": details},
+        )
+        self.assertEqual(len(cache), 1)
+
+    def test_cached_details_skip_the_browser(self):
+        """Test get_urls and fill_truncated_texts on a cache hit."""
+        cache = DetailCache(self.path)
+        downloader = WeiboDownloader(uid=123456, cache=cache)
+        details = {
+            "text": "full text",
+            "url": "https://m.weibo.cn/status/101",
+            "links": ["https://example.com"],
+        }
+        downloader.set_cached_details("detail", self.make_post(), details)
+        with patch.object(downloader, "extract_post_data_from_expand") as mock_expand:
+            url_post = self.make_post()
+            downloader.get_urls([url_post])
+            text_post = self.make_post(time="2023-01-01 08:00:00")
+            downloader.fill_truncated_texts([text_post])
+        mock_expand.assert_not_called()
+        for post in (url_post, text_post):
+            self.assertEqual(post["text"], "full text")
+            self.assertEqual(post["url"], details["url"])
+            self.assertEqual(post["links"], details["links"])
+            self.assertEqual(post["tracking_params"]["hash"], "card")
+        self.assertEqual(text_post["time"], "2023-01-01 08:00:00")
+        self.assertFalse(text_post["tracking_params"]["is_text_truncated"])
@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from weibo_downloader.cli import load_jobs
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.job_file = os.path.join(self.tempdir.name, "jobs.json")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write_jobs(self, content):
+        with open(self.job_file, "w", encoding="utf-8") as f:
+            json.dump(content, f)
+
+    def test_load_jobs_applies_defaults(self):
+        """Test merging defaults into jobs and formatting save paths."""
+        self.write_jobs(
+            {
+                "defaults": {"pages": 1, "save_media_directory": "./media/{account}/"},
+                "jobs": ["dummy_user", {"uid": 123456, "pages": 2}],
+            }
+        )
+        jobs = load_jobs(self.job_file)
+        self.assertEqual(jobs[0]["username"], "dummy_user")
+        self.assertEqual(jobs[0]["pages"], 1)
+        self.assertEqual(jobs[0]["save_path_json"], "./weibo_posts_dummy_user.json")
+        self.assertEqual(jobs[1]["pages"], 2)
+        self.assertEqual(jobs[1]["save_media_directory"], "./media/123456/")
+
+    def test_load_jobs_without_account(self):
+        """Test rejecting a job with neither username nor uid."""
+        self.write_jobs([{"pages": 1}])
+        with self.assertRaises(ValueError):
+            load_jobs(self.job_file)
+
+    def test_dry_run_does_not_load_selenium(self):
+        """Test that reading a job file does not import the browser backend."""
+        self.write_jobs(["dummy_user"])
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; from weibo_downloader.cli import main; "
+                "main(['--dry-run', sys.argv[1]]); print('selenium' in sys.modules)",
+                self.job_file,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout
+        self.assertTrue(output.strip().endswith("False"))
+
+    def test_load_jobs_with_invalid_types(self):
+        """Test rejecting non-object defaults and jobs with a ValueError."""
+        self.write_jobs({"defaults": ["pages"], "jobs": ["dummy_user"]})
+        with self.assertRaises(ValueError):
+            load_jobs(self.job_file)
+        self.write_jobs(["dummy_user", 5])
+        with self.assertRaisesRegex(ValueError, "Job 2"):
+            load_jobs(self.job_file)
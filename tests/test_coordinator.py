@@ -0,0 +1,151 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from weibo_downloader import CrawlCoordinator, RedisStore, SQLiteStore, split_date_range
+
+try:
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = None
+
+
+class TestSplitDateRange(unittest.TestCase):
+
+    def test_split_date_range(self):
+        """Test splitting a date range into shards, newest first."""
+        shards = split_date_range("2023-01-01", "2023-01-10", shard_days=4)
+        self.assertEqual(
+            shards,
+            [
+                ("2023-01-07", "2023-01-10"),
+                ("2023-01-03", "2023-01-06"),
+                ("2023-01-01", "2023-01-02"),
+            ],
+        )
+
+    def test_split_date_range_invalid(self):
+        """Test splitting a reversed date range."""
+        with self.assertRaises(ValueError):
+            split_date_range("2023-02-01", "2023-01-01")
+
+
+class TestCrawlCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.store = SQLiteStore(os.path.join(self.tempdir.name, "jobs.sqlite3"))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_enqueue_account_is_idempotent(self):
+        """Test enqueueing the same account and range twice."""
+        coordinator = CrawlCoordinator(self.store, worker_id="a")
+        added = coordinator.enqueue_account(
+            uid=123456, date_from="2023-01-01", date_to="2023-03-01"
+        )
+        self.assertEqual(len(added), 2)
+        self.assertEqual(
+            coordinator.enqueue_account(
+                uid=123456, date_from="2023-01-01", date_to="2023-03-01"
+            ),
+            [],
+        )
+        self.assertEqual(self.store.count_unfinished(), 2)
+
+    def test_lease_ownership(self):
+        """Test that a leased job is not handed to a second worker."""
+        CrawlCoordinator(self.store).enqueue_account(
+            uid=123456, date_from="2023-01-01", date_to="2023-01-01"
+        )
+        job = self.store.acquire_job("a", lease_seconds=60)
+        self.assertEqual(job["payload"]["date_from"], "2023-01-01")
+        self.assertIsNone(self.store.acquire_job("b", lease_seconds=60))
+        self.assertFalse(self.store.heartbeat(job["job_id"], "b", 60))
+        self.assertTrue(self.store.heartbeat(job["job_id"], "a", 60))
+        self.assertTrue(self.store.complete_job(job["job_id"], "a"))
+        self.assertEqual(self.store.count_unfinished(), 0)
+
+    def test_expired_lease_is_taken_over(self):
+        """Test that a job whose owner stopped heartbeating moves on."""
+        CrawlCoordinator(self.store).enqueue_account(
+            uid=123456, date_from="2023-01-01", date_to="2023-01-01"
+        )
+        job = self.store.acquire_job("a", lease_seconds=0.01)
+        time.sleep(0.05)
+        taken_over = self.store.acquire_job("b", lease_seconds=60)
+        self.assertEqual(taken_over["job_id"], job["job_id"])
+        self.assertEqual(taken_over["attempts"], 2)
+        self.assertFalse(self.store.complete_job(job["job_id"], "a"))
+
+    def test_claim_deduplicates(self):
+        """Test that only the first worker claims a post."""
+        first = CrawlCoordinator(self.store, worker_id="a")
+        second = CrawlCoordinator(self.store, worker_id="b")
+        self.assertTrue(first.claim("post", "123456:abc"))
+        self.assertFalse(second.claim("post", "123456:abc"))
+        self.assertTrue(second.claim("media", "123456:abc"))
+
+    @patch("weibo_downloader.weibo_downloader.request.urlretrieve")
+    def test_media_is_claimed_after_download(self, mock_urlretrieve):
+        """Test that a failed download does not block later attempts."""
+        coordinator = CrawlCoordinator(self.store, worker_id="a")
+        downloader = coordinator.build_downloader(
+            {"username": None, "uid": 123456, "date_from": None, "date_to": None},
+            {},
+        )
+        link = "https://wx1.sinaimg.cn/large/abc.jpg"
+        file_path = os.path.join(self.tempdir.name, "abc.jpg")
+        mock_urlretrieve.side_effect = OSError("connection reset")
+        with self.assertRaises(OSError):
+            downloader.download(link, file_path)
+        self.assertFalse(self.store.has_seen("media", link))
+        mock_urlretrieve.side_effect = None
+        self.assertEqual(downloader.download(link, file_path)["status"], "success")
+        self.assertTrue(self.store.has_seen("media", link))
+        self.assertEqual(
+            downloader.download(link, file_path + ".copy")["status"],
+            "file already exists",
+        )
+
+
+@unittest.skipUnless(fakeredis, "fakeredis with Lua support is not installed")
+class TestRedisStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = RedisStore(client=fakeredis.FakeRedis())
+        CrawlCoordinator(self.store).enqueue_account(
+            uid=123456, date_from="2023-01-01", date_to="2023-01-01"
+        )
+
+    def test_lease_ownership(self):
+        """Test that a leased job is not handed to a second worker."""
+        job = self.store.acquire_job("a", lease_seconds=60)
+        self.assertEqual(job["attempts"], 1)
+        self.assertIsNone(self.store.acquire_job("b", lease_seconds=60))
+        self.assertFalse(self.store.heartbeat(job["job_id"], "b", 60))
+        self.assertTrue(self.store.heartbeat(job["job_id"], "a", 60))
+        self.assertFalse(self.store.complete_job(job["job_id"], "b"))
+        self.assertTrue(self.store.complete_job(job["job_id"], "a"))
+        self.assertEqual(self.store.count_unfinished(), 0)
+        self.assertIsNone(self.store.acquire_job("b", lease_seconds=60))
+
+    def test_expired_lease_is_taken_over(self):
+        """Test that a former owner cannot end a lease taken over by another."""
+        job = self.store.acquire_job("a", lease_seconds=0.01)
+        time.sleep(0.05)
+        taken_over = self.store.acquire_job("b", lease_seconds=60)
+        self.assertEqual(taken_over["attempts"], 2)
+        self.assertFalse(self.store.complete_job(job["job_id"], "a"))
+        self.assertFalse(self.store.release_job(job["job_id"], "a"))
+        self.assertEqual(self.store.job_statuses(), {job["job_id"]: "pending"})
+        self.assertTrue(self.store.release_job(job["job_id"], "b", give_up=True))
+        self.assertEqual(self.store.job_statuses(), {job["job_id"]: "failed"})
+
+    def test_mark_seen(self):
+        """Test that only the first caller marks a key."""
+        self.assertTrue(self.store.mark_seen("post", "123456:abc"))
+        self.assertFalse(self.store.mark_seen("post", "123456:abc"))
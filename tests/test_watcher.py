@@ -0,0 +1,133 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock
+from weibo_downloader import TimelineWatcher, WeiboDownloader
+
+
+def timeline_response(*mblogs):
+    mock_response = MagicMock()
+    mock_response.json.return_value = {
+        "data": {"cards": [{"card_type": 9, "mblog": mblog} for mblog in mblogs]}
+    }
+    return mock_response
+
+
+class TestTimelineWatcher(unittest.TestCase):
+
+    def test_schedule_spreads_polls(self):
+        """Test that first polls are spread evenly over the interval."""
+        watcher = TimelineWatcher(uids=[1, 2, 3, 4], interval=40)
+        slots = sorted(slot for slot, _, _ in watcher.schedule(1000))
+        self.assertEqual(slots, [1000, 1010, 1020, 1030])
+
+    def test_next_run_does_not_burst(self):
+        """Test that an account that fell behind is not polled repeatedly."""
+        watcher = TimelineWatcher(uids=[1], interval=30, jitter=0)
+        self.assertEqual(watcher.next_run(1000, 1010), (1030, 1030))
+        self.assertEqual(watcher.next_run(1000, 1100), (1100, 1100))
+
+    @patch("requests.get")
+    def test_only_new_posts_are_extracted(self, mock_get):
+        """Test that the browser is only used for posts newer than known."""
+        watcher = TimelineWatcher(uids=[123456])
+        account = watcher.accounts[0]
+        with patch.object(watcher, "extract_new_posts") as mock_extract:
+            mock_get.return_value = timeline_response(
+                {"id": "900", "isTop": 1}, {"id": "100"}, {"id": "90"}
+            )
+            self.assertEqual(watcher.check_account(account), [])
+            self.assertEqual(watcher.newest_ids["123456"], 100)
+            mock_get.return_value = timeline_response({"id": "100"}, {"id": "90"})
+            self.assertEqual(watcher.check_account(account), [])
+            mock_extract.assert_not_called()
+            mock_extract.return_value = [{"url": "https://m.weibo.cn/status/101"}]
+            mock_get.return_value = timeline_response({"id": "101"}, {"id": "100"})
+            self.assertEqual(
+                watcher.check_account(account),
+                [{"url": "https://m.weibo.cn/status/101"}],
+            )
+            new_posts = mock_extract.call_args[0][1]
+            self.assertEqual([post["id"] for post in new_posts], [101])
+            self.assertEqual(watcher.newest_ids["123456"], 101)
+
+    def test_extract_new_posts_keeps_fresh_posts(self):
+        """Test the since filter against API times in Beijing time."""
+        watcher = TimelineWatcher(uids=[123456])
+        downloader = watcher.get_downloader(watcher.accounts[0])
+        now = datetime.now().replace(second=0, microsecond=0)
+        created_at = now.astimezone(timezone(timedelta(hours=8))).strftime(
+            "%a %b %d %H:%M:%S %z %Y"
+        )
+        cards = [
+            {"time": str(now), "url": "https://m.weibo.cn/status/101"},
+            {"time": str(now), "url": "https://m.weibo.cn/status/99"},
+            {"time": str(now - timedelta(days=3)), "url": "https://m.weibo.cn/status/50"},
+        ]
+        extracted = []
+
+        def run_generator(yield_data=False):
+            for card in cards:
+                post = downloader.extract_post_data(card)
+                if post:
+                    extracted.append(post)
+                    yield post
+
+        with patch.object(
+            WeiboDownloader, "extract_post_data", side_effect=lambda card: dict(card)
+        ), patch.object(downloader, "run_generator", run_generator):
+            posts = watcher.extract_new_posts(
+                downloader, [{"id": 101, "created_at": created_at}]
+            )
+        self.assertEqual(posts, [cards[0]])
+        self.assertEqual(extracted, cards[:2])
+
+    @patch("requests.get")
+    def test_unextracted_posts_stay_new(self, mock_get):
+        """Test that the newest known ID only moves past extracted posts."""
+        watcher = TimelineWatcher(uids=[123456])
+        watcher.newest_ids["123456"] = 100
+        account = watcher.accounts[0]
+        mock_get.return_value = timeline_response({"id": "102"}, {"id": "101"})
+        post_101 = {"url": "https://m.weibo.cn/status/101"}
+        post_102 = {"url": "https://m.weibo.cn/status/102"}
+        with patch.object(watcher, "extract_new_posts") as mock_extract:
+            mock_extract.return_value = []
+            self.assertEqual(watcher.check_account(account), [])
+            self.assertEqual(watcher.newest_ids["123456"], 100)
+            mock_extract.return_value = [post_102]
+            self.assertEqual(watcher.check_account(account), [post_102])
+            self.assertEqual(watcher.newest_ids["123456"], 100)
+            mock_extract.return_value = [post_102, post_101]
+            self.assertEqual(watcher.check_account(account), [post_101])
+            self.assertEqual(watcher.newest_ids["123456"], 102)
+
+    def test_posts_without_id_are_dropped(self):
+        """Test that posts whose url was not resolved are not emitted."""
+        watcher = TimelineWatcher(uids=[123456])
+        downloader = watcher.get_downloader(watcher.accounts[0])
+        posts = [{"url": None}, {"url": "https://m.weibo.cn/status/101"}]
+        with patch.object(downloader, "run_generator", return_value=iter(posts)):
+            self.assertEqual(
+                watcher.extract_new_posts(
+                    downloader, [{"id": 101, "created_at": None}]
+                ),
+                posts[1:],
+            )
+
+    @patch("requests.get")
+    def test_gap_is_given_up_after_max_polls(self, mock_get):
+        """Test that a post never shown on the page stops opening a browser."""
+        watcher = TimelineWatcher(uids=[123456], max_gap_polls=3)
+        watcher.newest_ids["123456"] = 100
+        account = watcher.accounts[0]
+        mock_get.return_value = timeline_response({"id": "102"}, {"id": "101"})
+        post_102 = {"url": "https://m.weibo.cn/status/102"}
+        with patch.object(watcher, "extract_new_posts") as mock_extract:
+            mock_extract.return_value = [post_102]
+            self.assertEqual(watcher.check_account(account), [post_102])
+            for _ in range(2):
+                self.assertEqual(watcher.newest_ids["123456"], 100)
+                self.assertEqual(watcher.check_account(account), [])
+            self.assertEqual(watcher.newest_ids["123456"], 102)
+            self.assertEqual(watcher.check_account(account), [])
+            self.assertEqual(mock_extract.call_count, 3)
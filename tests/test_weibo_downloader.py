@@ -1,5 +1,6 @@
 import unittest
 from unittest.mock import patch, MagicMock
+from selenium.common.exceptions import TimeoutException
 from weibo_downloader import WeiboDownloader
 
 class TestWeiboDownloader(unittest.TestCase):
@@ -45,3 +46,152 @@ class TestWeiboDownloader(unittest.TestCase):
         downloader = WeiboDownloader(username="dummy_user")
         with self.assertRaises(ValueError):
             downloader.filter_date_format("invalid-date")
+
+    def test_lightweight_browser_stages(self):
+        """Test blocking URLs per stage with the lightweight browser."""
+        downloader = WeiboDownloader(uid="123456", enable_lightweight_browser=True)
+        downloader.driver = MagicMock()
+        downloader.set_browser_stage("video")
+        downloader.set_browser_stage("video")
+        downloader.driver.execute_cdp_cmd.assert_called_once()
+        command, params = downloader.driver.execute_cdp_cmd.call_args[0]
+        self.assertEqual(command, "Network.setBlockedURLs")
+        self.assertIn("*.jpg*", params["urls"])
+        self.assertNotIn("*.mp4*", params["urls"])
+        downloader.set_browser_stage("timeline")
+        self.assertIn("*.mp4*", downloader.driver.execute_cdp_cmd.call_args[0][1]["urls"])
+
+    def test_lightweight_browser_disabled(self):
+        """Test that no URLs are blocked by default."""
+        downloader = WeiboDownloader(uid="123456")
+        downloader.driver = MagicMock()
+        downloader.set_browser_stage("timeline")
+        downloader.driver.execute_cdp_cmd.assert_not_called()
+
+    def test_get_video_links_in_batch(self):
+        """Test resolving video links from page data with one script call."""
+        downloader = WeiboDownloader(
+            uid="123456", video_quality_preference=["mp4_720p_mp4"]
+        )
+        cards = [MagicMock(text="card with video"), MagicMock(text="card without")]
+        downloader.driver = MagicMock()
+        downloader.driver.find_elements.return_value = cards
+        video_urls = {
+            "mp4_1080p_mp4": "https://f.video.weibocdn.com/1080.mp4",
+            "mp4_720p_mp4": "https://f.video.weibocdn.com/720.mp4",
+        }
+        downloader.driver.execute_script.return_value = [{"urls": video_urls}, None]
+        post = {
+            "video": None,
+            "tracking_params": {
+                "hash": downloader.generate_hash(cards[0]),
+                "video_hash": "video",
+            },
+        }
+        self.assertEqual(downloader.get_video_links_in_batch([post]), [])
+        self.assertEqual(post["video"], "https://f.video.weibocdn.com/720.mp4")
+        self.assertEqual(post["tracking_params"]["video_urls"], video_urls)
+        downloader.driver.execute_script.assert_called_once()
+
+    def test_api_format_records_all_video_qualities(self):
+        """Test that every quality survives get_urls into page_info.urls."""
+        downloader = WeiboDownloader(uid="123456")
+        card = MagicMock(text="card with video")
+        downloader.driver = MagicMock()
+        downloader.driver.find_elements.return_value = [card]
+        video_urls = {
+            "mp4_720p_mp4": "https://f.video.weibocdn.com/720.mp4?Expires=1",
+            "mp4_ld_mp4": "https://f.video.weibocdn.com/ld.mp4?Expires=1",
+        }
+        downloader.driver.execute_script.return_value = [{"urls": video_urls}]
+        post = {
+            "username": "",
+            "uid": "123456",
+            "text": "text",
+            "time": "2023-01-01 00:00:00",
+            "thumbnail_images": [],
+            "images": [],
+            "video": None,
+            "links": [],
+            "url": None,
+            "tracking_params": {
+                "is_text_truncated": False,
+                "hash": downloader.generate_hash(card),
+                "video_hash": "video",
+            },
+        }
+        expand_post = dict(
+            post,
+            url="https://m.weibo.cn/status/1",
+            tracking_params={"is_text_truncated": False, "hash": "expanded"},
+        )
+        downloader.get_video_links([post])
+        with patch.object(
+            downloader, "extract_post_data_from_expand", return_value=expand_post
+        ):
+            downloader.get_urls([post])
+        self.assertEqual(post["url"], "https://m.weibo.cn/status/1")
+        self.assertEqual(post["tracking_params"]["video_urls"], video_urls)
+        post_in_api_format = downloader.get_posts_in_api_format([post])[0]
+        self.assertEqual(post_in_api_format["mblog"]["page_info"]["urls"], video_urls)
+
+    def test_run_generator_stops_at_end_of_timeline(self):
+        """Test that a scroll loading no new cards ends the crawl cleanly."""
+        downloader = WeiboDownloader(
+            uid="123456",
+            date_from="2023-01-01",
+            save_path_csv=None,
+            save_path_json=None,
+        )
+
+        def prepare_webdriver():
+            downloader.driver = MagicMock()
+            downloader.wait = MagicMock()
+            downloader.wait.until.side_effect = TimeoutException("no new cards")
+
+        with patch.object(downloader, "prepare_webdriver", prepare_webdriver):
+            self.assertEqual(list(downloader.run_generator(yield_data=True)), [])
+        self.assertEqual(downloader.wait.until.call_count, 2)
+        downloader.driver.quit.assert_called_once()
+
+    def test_run_generator_retries_a_stalled_scroll(self):
+        """Test that one timeout is retried and later stalls are raised."""
+        downloader = WeiboDownloader(
+            uid="123456",
+            date_from="2023-01-01",
+            save_path_csv=None,
+            save_path_json=None,
+        )
+        post = {"url": "https://m.weibo.cn/status/101"}
+
+        def prepare_webdriver():
+            downloader.driver = MagicMock()
+            downloader.driver.find_elements.side_effect = [[], [], ["card"]]
+            downloader.wait = MagicMock()
+            downloader.wait.until.side_effect = [
+                TimeoutException("slow page"),
+                True,
+                TimeoutException("slow page"),
+                TimeoutException("slow page"),
+            ]
+
+        def fetch_more_posts():
+            downloader.card_hashes.add("card")
+            return [post]
+
+        with patch.object(
+            downloader, "prepare_webdriver", prepare_webdriver
+        ), patch.object(downloader, "fetch_more_posts", fetch_more_posts):
+            posts = downloader.run_generator(yield_data=True)
+            self.assertEqual(next(posts), post)
+            with self.assertRaises(TimeoutException):
+                next(posts)
+
+    def test_close_if_open(self):
+        """Test closing after a failure, with or without a browser."""
+        downloader = WeiboDownloader(uid="123456")
+        downloader.close_if_open()
+        downloader.driver = MagicMock()
+        downloader.driver.quit.side_effect = Exception("browser already gone")
+        downloader.close_if_open()
+        downloader.driver.quit.assert_called_once()
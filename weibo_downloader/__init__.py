@@ -1 +1,28 @@
-from .weibo_downloader import WeiboDownloader, get_weibo_posts_by_name
\ No newline at end of file
+import importlib
+
+# Submodules are imported on first use, so that e.g. the command line entry
+# point starts without loading selenium until a job actually runs.
+_exports = {
+    "WeiboDownloader": ".weibo_downloader",
+    "get_weibo_posts_by_name": ".weibo_downloader",
+    "DetailCache": ".cache",
+    "CrawlCoordinator": ".coordinator",
+    "SQLiteStore": ".coordinator",
+    "RedisStore": ".coordinator",
+    "split_date_range": ".coordinator",
+    "TimelineWatcher": ".watcher",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,99 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+# Weibo video links are signed and stop working after a few hours, so they
+# are kept for much shorter than UIDs and expanded post details.
+VIDEO_LINK_TTL = 3 * 3600
+
+
+class DetailCache:
+    """
+    On-disk cache of resolved UIDs and expanded post details, shared between
+    runs. Entries expire after ttl seconds, and the least recently used ones
+    are evicted once more than max_entries are stored.
+    """
+
+    def __init__(
+        self, path="./weibo_cache.sqlite3", ttl=30 * 24 * 3600, max_entries=100000
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed_at "
+                "ON entries (accessed_at)"
+            )
+
+    def get(self, namespace, key, default=None):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, str(key)),
+            ).fetchone()
+            if not row:
+                return default
+            if row[1] < now:
+                self.conn.execute(
+                    "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                    (namespace, str(key)),
+                )
+                return default
+            self.conn.execute(
+                "UPDATE entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, namespace, str(key)),
+            )
+            return json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(namespace, key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    namespace,
+                    str(key),
+                    json.dumps(value, ensure_ascii=False),
+                    now + (ttl if ttl is not None else self.ttl),
+                    now,
+                ),
+            )
+            count = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries "
+                    "ORDER BY accessed_at, rowid LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def delete(self, namespace, key):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, str(key)),
+            )
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM entries")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,124 @@
+import argparse
+import json
+import sys
+import time
+
+DEFAULT_OPTIONS = {
+    "save_path_csv": "./weibo_posts_{account}.csv",
+    "save_path_json": "./weibo_posts_{account}.json",
+}
+
+
+def load_jobs(path):
+    """
+    Read a job file: either a list of jobs, or an object with a "jobs" list
+    and "defaults" shared by every job. A job holds a username or uid plus
+    any WeiboDownloader options; {account} in save paths is replaced by the
+    job's username or uid.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        content = json.load(f)
+    if isinstance(content, list):
+        content = {"jobs": content}
+    if not isinstance(content, dict) or not isinstance(content.get("jobs"), list):
+        raise ValueError('Job file must be a list of jobs or contain a "jobs" list.')
+    if not isinstance(content.get("defaults", {}), dict):
+        raise ValueError('Job file "defaults" must be an object of options.')
+    defaults = dict(DEFAULT_OPTIONS, **content.get("defaults", {}))
+    jobs = []
+    for i, job in enumerate(content["jobs"]):
+        if isinstance(job, str):
+            job = {"username": job}
+        if not isinstance(job, dict):
+            raise ValueError(
+                "Job {} must be a username or an object of options.".format(i + 1)
+            )
+        options = dict(defaults, **job)
+        if not options.get("username") and not options.get("uid"):
+            raise ValueError("Job {} has neither a username nor a uid.".format(i + 1))
+        account = str(options.get("username") or options.get("uid"))
+        for name in ("save_path_csv", "save_path_json", "save_media_directory"):
+            if options.get(name):
+                options[name] = options[name].format(account=account)
+        jobs.append(options)
+    return jobs
+
+
+def run_jobs(jobs, stop_on_error=False, quiet=False):
+    # Heavy backends (selenium, webdriver_manager, requests) load here, once
+    # for the whole job list.
+    from .cache import DetailCache
+    from .weibo_downloader import WeiboDownloader
+
+    caches = {}
+    failed = 0
+    for i, options in enumerate(jobs):
+        options = dict(options)
+        cache = options.get("cache")
+        if isinstance(cache, str):
+            # Jobs naming the same cache file share one open cache.
+            if cache not in caches:
+                caches[cache] = DetailCache(cache)
+            options["cache"] = caches[cache]
+        account = options.get("username") or options.get("uid")
+        ticktok = time.time()
+        downloader = None
+        try:
+            downloader = WeiboDownloader(**options)
+            if quiet:
+                for _ in downloader.run_generator(yield_data=True):
+                    pass
+            else:
+                downloader.run()
+        except Exception as e:
+            failed += 1
+            print(
+                "[Error] Job {}/{} ({}) failed: {}".format(
+                    i + 1, len(jobs), account, e
+                ),
+                file=sys.stderr,
+            )
+            if downloader is not None:
+                downloader.close_if_open()
+            if stop_on_error:
+                break
+            continue
+        if not quiet:
+            print(
+                "Finished job {}/{} ({}) in {}s".format(
+                    i + 1, len(jobs), account, round(time.time() - ticktok, 2)
+                )
+            )
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="weibo-downloader",
+        description="Download weibo posts and media for every account in a job file.",
+    )
+    parser.add_argument("job_file", help="JSON file listing the accounts to download.")
+    parser.add_argument(
+        "--stop-on-error",
+        action="store_true",
+        help="Stop at the first failed job instead of continuing with the rest.",
+    )
+    parser.add_argument("--quiet", action="store_true", help="Only print errors.")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the jobs with their options without running them.",
+    )
+    args = parser.parse_args(argv)
+    try:
+        jobs = load_jobs(args.job_file)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(str(e))
+    if args.dry_run:
+        print(json.dumps(jobs, indent=4, ensure_ascii=False))
+        return 0
+    return 1 if run_jobs(jobs, args.stop_on_error, args.quiet) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
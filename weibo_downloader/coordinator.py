@@ -0,0 +1,502 @@
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from .weibo_downloader import WeiboDownloader
+
+
+def split_date_range(date_from, date_to=None, shard_days=30):
+    """
+    Split the inclusive range date_from..date_to (YYYY-MM-DD) into shards of at
+    most shard_days days, newest shard first. date_to defaults to today.
+    """
+    if shard_days < 1:
+        raise ValueError("shard_days must be at least 1.")
+    try:
+        start = datetime.strptime(date_from, "%Y-%m-%d").date()
+        end = (
+            datetime.strptime(date_to, "%Y-%m-%d").date()
+            if date_to
+            else datetime.now().date()
+        )
+    except ValueError:
+        raise ValueError("Incorrect date format, should be YYYY-MM-DD")
+    if start > end:
+        raise ValueError("date_from must not be later than date_to.")
+    shards = []
+    shard_end = end
+    while shard_end >= start:
+        shard_start = max(start, shard_end - timedelta(days=shard_days - 1))
+        shards.append((str(shard_start), str(shard_end)))
+        shard_end = shard_start - timedelta(days=1)
+    return shards
+
+
+class SQLiteStore:
+    """
+    Coordination store backed by a local SQLite file, for several processes
+    on one host and for tests. SQLite locking is unreliable over network file
+    systems, so use RedisStore to coordinate several machines.
+    """
+
+    def __init__(self, path="./weibo_coordination.sqlite3", timeout=30):
+        self.path = path
+        self.timeout = timeout
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', owner TEXT, "
+                "lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, owner TEXT, "
+                "PRIMARY KEY (namespace, key))"
+            )
+
+    def connect(self):
+        # A fresh connection per call keeps the store safe to use from the
+        # heartbeat thread and from several processes at once.
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        return _SQLiteTransaction(conn)
+
+    def add_job(self, job_id, payload):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO jobs (job_id, payload) VALUES (?, ?)",
+                (job_id, json.dumps(payload, ensure_ascii=False)),
+            )
+            return cursor.rowcount == 1
+
+    def acquire_job(self, worker_id, lease_seconds):
+        now = time.time()
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT job_id, payload, attempts FROM jobs WHERE status = 'pending' "
+                "AND (owner IS NULL OR lease_until < ?) ORDER BY rowid LIMIT 1",
+                (now,),
+            ).fetchone()
+            if not row:
+                return None
+            conn.execute(
+                "UPDATE jobs SET owner = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE job_id = ?",
+                (worker_id, now + lease_seconds, row[0]),
+            )
+            return {
+                "job_id": row[0],
+                "payload": json.loads(row[1]),
+                "attempts": row[2] + 1,
+            }
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND owner = ? "
+                "AND status = 'pending'",
+                (time.time() + lease_seconds, job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def complete_job(self, job_id, worker_id):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', owner = NULL, lease_until = NULL "
+                "WHERE job_id = ? AND owner = ? AND status = 'pending'",
+                (job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def release_job(self, job_id, worker_id, give_up=False):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, lease_until = NULL "
+                "WHERE job_id = ? AND owner = ? AND status = 'pending'",
+                ("failed" if give_up else "pending", job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def count_unfinished(self):
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'pending'"
+            ).fetchone()[0]
+
+    def job_statuses(self):
+        with self.connect() as conn:
+            return dict(conn.execute("SELECT job_id, status FROM jobs").fetchall())
+
+    def has_seen(self, namespace, key):
+        with self.connect() as conn:
+            return (
+                conn.execute(
+                    "SELECT 1 FROM seen WHERE namespace = ? AND key = ?",
+                    (namespace, key),
+                ).fetchone()
+                is not None
+            )
+
+    def mark_seen(self, namespace, key, owner=None):
+        """Return True only for the first caller to mark (namespace, key)."""
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO seen (namespace, key, owner) VALUES (?, ?, ?)",
+                (namespace, key, owner),
+            )
+            return cursor.rowcount == 1
+
+
+class _SQLiteTransaction:
+    # sqlite3's own context manager neither closes the connection nor takes
+    # the write lock up front, which acquire_job needs to be atomic.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.conn.close()
+
+
+# Each lease operation checks the owner and acts in one script, so a lease
+# that expires in between cannot be renewed or ended by its former owner.
+_REDIS_ACQUIRE_SCRIPT = """
+if redis.call("hexists", KEYS[2], ARGV[1]) == 1 then
+    return false
+end
+if not redis.call("set", KEYS[1], ARGV[2], "NX", "PX", ARGV[3]) then
+    return false
+end
+return redis.call("hincrby", KEYS[3], ARGV[1], 1)
+"""
+
+_REDIS_HEARTBEAT_SCRIPT = """
+if redis.call("get", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call("pexpire", KEYS[1], ARGV[2])
+"""
+
+_REDIS_FINISH_SCRIPT = """
+if redis.call("get", KEYS[1]) ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] ~= "" then
+    redis.call("hset", KEYS[2], ARGV[1], ARGV[3])
+end
+redis.call("del", KEYS[1])
+return 1
+"""
+
+
+class RedisStore:
+    """
+    Coordination store backed by Redis, or any client exposing the same
+    commands including EVAL (e.g. fakeredis with Lua support). Leases are
+    keys with a PX expiry, so a node that dies simply lets its lease run out.
+    """
+
+    def __init__(
+        self, client=None, url="redis://localhost:6379/0", prefix="weibo_downloader"
+    ):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError(
+                    "RedisStore requires the redis package, install it with "
+                    "`pip install redis` or pass a client explicitly."
+                )
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def key(self, *parts):
+        return ":".join((self.prefix,) + tuple(parts))
+
+    def decode(self, value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def add_job(self, job_id, payload):
+        if not self.client.hsetnx(
+            self.key("payload"), job_id, json.dumps(payload, ensure_ascii=False)
+        ):
+            return False
+        self.client.rpush(self.key("jobs"), job_id)
+        return True
+
+    def acquire_job(self, worker_id, lease_seconds):
+        for job_id in self.client.lrange(self.key("jobs"), 0, -1):
+            job_id = self.decode(job_id)
+            attempts = self.client.eval(
+                _REDIS_ACQUIRE_SCRIPT,
+                3,
+                self.key("lease", job_id),
+                self.key("status"),
+                self.key("attempts"),
+                job_id,
+                worker_id,
+                int(lease_seconds * 1000),
+            )
+            if attempts:
+                payload = self.decode(self.client.hget(self.key("payload"), job_id))
+                return {
+                    "job_id": job_id,
+                    "payload": json.loads(payload),
+                    "attempts": int(attempts),
+                }
+        return None
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        return bool(
+            self.client.eval(
+                _REDIS_HEARTBEAT_SCRIPT,
+                1,
+                self.key("lease", job_id),
+                worker_id,
+                int(lease_seconds * 1000),
+            )
+        )
+
+    def finish_lease(self, job_id, worker_id, status):
+        return bool(
+            self.client.eval(
+                _REDIS_FINISH_SCRIPT,
+                2,
+                self.key("lease", job_id),
+                self.key("status"),
+                job_id,
+                worker_id,
+                status,
+            )
+        )
+
+    def complete_job(self, job_id, worker_id):
+        return self.finish_lease(job_id, worker_id, "done")
+
+    def release_job(self, job_id, worker_id, give_up=False):
+        return self.finish_lease(job_id, worker_id, "failed" if give_up else "")
+
+    def count_unfinished(self):
+        return self.client.llen(self.key("jobs")) - self.client.hlen(self.key("status"))
+
+    def job_statuses(self):
+        statuses = {
+            self.decode(k): self.decode(v)
+            for k, v in self.client.hgetall(self.key("status")).items()
+        }
+        return {
+            job_id: statuses.get(job_id, "pending")
+            for job_id in map(self.decode, self.client.lrange(self.key("jobs"), 0, -1))
+        }
+
+    def has_seen(self, namespace, key):
+        return bool(self.client.sismember(self.key("seen", namespace), key))
+
+    def mark_seen(self, namespace, key, owner=None):
+        """Return True only for the first caller to mark (namespace, key)."""
+        return self.client.sadd(self.key("seen", namespace), key) == 1
+
+
+class _CoordinatedWeiboDownloader(WeiboDownloader):
+    # Records every downloaded media file in the shared store, so nodes with
+    # separate disks do not fetch the same file twice. A file is only marked
+    # once it is on disk, so a failed download is retried by later attempts.
+    def __init__(self, coordinator, **kwargs):
+        self.coordinator = coordinator
+        super().__init__(**kwargs)
+
+    def download(self, link, file_path):
+        media_key = link.split("?")[0]
+        if (
+            not self.enable_download_media_overwrite
+            and self.coordinator.store.has_seen("media", media_key)
+        ):
+            return {"status": "file already exists"}
+        response = super().download(link, file_path)
+        self.coordinator.claim("media", media_key)
+        return response
+
+
+class CrawlCoordinator:
+    """
+    Shares crawl jobs (one account and date shard each) between any number of
+    nodes through a store. Each node runs run_worker(); a job is owned through
+    a lease that a background heartbeat keeps alive, and is handed to another
+    node when its owner stops heartbeating.
+    """
+
+    def __init__(
+        self,
+        store,
+        worker_id=None,
+        lease_seconds=300,
+        heartbeat_interval=None,
+        max_attempts=3,
+        poll_interval=10,
+    ):
+        self.store = store
+        self.worker_id = worker_id or "{}-{}-{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval or lease_seconds / 3
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+
+    def enqueue_account(
+        self, username=None, uid=None, date_from=None, date_to=None, shard_days=30
+    ):
+        """
+        Add one job per date shard of an account. Enqueueing the same account
+        and range again is a no-op, so every node may run the same setup code.
+        Returns the ids of the jobs that were newly added.
+        """
+        if not uid and not username:
+            raise ValueError("Either uid or username must be specified.")
+        if uid and username:
+            raise ValueError("Only one of uid or username can be specified.")
+        if not date_from:
+            raise ValueError("date_from is required to shard a crawl.")
+        account = str(uid) if uid else username
+        added = []
+        for shard_from, shard_to in split_date_range(date_from, date_to, shard_days):
+            job_id = "{}:{}:{}".format(account, shard_from, shard_to)
+            payload = {
+                "username": username,
+                "uid": uid,
+                "date_from": shard_from,
+                "date_to": shard_to,
+            }
+            if self.store.add_job(job_id, payload):
+                added.append(job_id)
+        return added
+
+    def claim(self, namespace, key):
+        return self.store.mark_seen(namespace, key, self.worker_id)
+
+    def get_post_key(self, post):
+        if "mblog" in post:
+            # Posts in API format (enable_simplified_json=False)
+            mblog = post["mblog"]
+            post_id = (
+                mblog.get("id")
+                or hashlib.md5(
+                    (mblog.get("created_at", "") + mblog.get("text", "")).encode()
+                ).hexdigest()
+            )
+            return str(mblog["user"]["id"]) + ":" + post_id
+        if post["url"]:
+            return str(post["uid"]) + ":" + post["url"].split("/")[-1]
+        return str(post["uid"]) + ":" + post["tracking_params"]["hash"]
+
+    def build_downloader(self, payload, downloader_kwargs):
+        kwargs = dict(downloader_kwargs)
+        fields = {
+            "account": payload["uid"] or payload["username"],
+            "date_from": payload["date_from"],
+            "date_to": payload["date_to"],
+        }
+        for name in ("save_path_csv", "save_path_json"):
+            if kwargs.get(name):
+                kwargs[name] = kwargs[name].format(**fields)
+        return _CoordinatedWeiboDownloader(
+            self,
+            username=payload["username"],
+            uid=payload["uid"],
+            date_from=payload["date_from"],
+            date_to=payload["date_to"],
+            **kwargs
+        )
+
+    def run_worker(self, stop_when_empty=True, **downloader_kwargs):
+        """
+        Take jobs from the store until none are left (or forever, if
+        stop_when_empty is False) and yield every post no other node has
+        yielded yet. Extra keyword arguments are passed to WeiboDownloader;
+        save_path_csv and save_path_json may contain {account}, {date_from}
+        and {date_to} so shards do not overwrite each other, and both default
+        to None because posts are delivered through this generator.
+        """
+        downloader_kwargs.setdefault("save_path_csv", None)
+        downloader_kwargs.setdefault("save_path_json", None)
+        for reserved in ("username", "uid", "date_from", "date_to", "pages"):
+            if reserved in downloader_kwargs:
+                raise ValueError(
+                    reserved + " is set per job and cannot be passed to run_worker."
+                )
+        while True:
+            job = self.store.acquire_job(self.worker_id, self.lease_seconds)
+            if not job:
+                if stop_when_empty and not self.store.count_unfinished():
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            for post in self.run_job(job, downloader_kwargs):
+                yield post
+
+    def run_job(self, job, downloader_kwargs):
+        lease_lost = threading.Event()
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(self.heartbeat_interval):
+                if not self.store.heartbeat(
+                    job["job_id"], self.worker_id, self.lease_seconds
+                ):
+                    lease_lost.set()
+                    return
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        downloader = None
+        try:
+            downloader = self.build_downloader(job["payload"], downloader_kwargs)
+            for post in downloader.run_generator(yield_data=True):
+                if lease_lost.is_set():
+                    # Another node may have taken the job over, let it finish.
+                    print(
+                        "[Warning] Lost lease on job {}, abandoning it.".format(
+                            job["job_id"]
+                        )
+                    )
+                    downloader.close_if_open()
+                    return
+                if self.claim("post", self.get_post_key(post)):
+                    yield post
+        except GeneratorExit:
+            # The consumer stopped early, hand the job back right away.
+            if downloader is not None:
+                downloader.close_if_open()
+            self.store.release_job(job["job_id"], self.worker_id)
+            raise
+        except Exception as e:
+            print("[Error] Job {} failed: {}".format(job["job_id"], e))
+            if downloader is not None:
+                downloader.close_if_open()
+            self.store.release_job(
+                job["job_id"],
+                self.worker_id,
+                give_up=job["attempts"] >= self.max_attempts,
+            )
+        else:
+            self.store.complete_job(job["job_id"], self.worker_id)
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+    def work(self, stop_when_empty=True, **downloader_kwargs):
+        # Consumes the generator to crawl all jobs
+        for _ in self.run_worker(stop_when_empty, **downloader_kwargs):
+            pass
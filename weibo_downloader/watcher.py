@@ -0,0 +1,284 @@
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+import requests
+from .weibo_downloader import WeiboDownloader
+
+
+class _WatchedWeiboDownloader(WeiboDownloader):
+    # Drops posts older than `since` before they are expanded or downloaded,
+    # so only the head of the timeline goes through full extraction.
+    since = None
+
+    def extract_post_data(self, card_main):
+        post_data = super().extract_post_data(card_main)
+        if post_data and self.since and post_data["time"] < self.since:
+            return None
+        return post_data
+
+
+class TimelineWatcher:
+    """
+    Watches many accounts for new posts. The head of each timeline is polled
+    through the lightweight JSON endpoint every `interval` seconds, with the
+    polls spread evenly over the interval. Only accounts that have posts newer
+    than the newest known post ID open a browser, and only those new posts
+    are extracted and have their media downloaded.
+    """
+
+    def __init__(
+        self,
+        usernames=(),
+        uids=(),
+        interval=30,
+        jitter=0.1,
+        max_concurrency=8,
+        max_browsers=1,
+        state_path=None,
+        emit_existing=False,
+        max_gap_polls=5,
+        on_post=None,
+        timeline_api_url="https://m.weibo.cn/api/container/getIndex",
+        **downloader_kwargs
+    ):
+        if not usernames and not uids:
+            raise ValueError("At least one username or uid must be specified.")
+        for reserved in ("username", "uid", "date_from", "date_to", "pages"):
+            if reserved in downloader_kwargs:
+                raise ValueError(
+                    reserved + " is set per account and cannot be passed to "
+                    "TimelineWatcher."
+                )
+        downloader_kwargs.setdefault("save_path_csv", None)
+        downloader_kwargs.setdefault("save_path_json", None)
+        downloader_kwargs["enable_get_urls"] = True  # Post IDs come from urls
+        self.accounts = [("username", u) for u in usernames] + [
+            ("uid", u) for u in uids
+        ]
+        self.interval = interval
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.browser_slots = threading.Semaphore(max_browsers)
+        self.state_path = state_path
+        self.emit_existing = emit_existing
+        self.max_gap_polls = max_gap_polls
+        self.on_post = on_post
+        self.timeline_api_url = timeline_api_url
+        self.request_timeout = 10
+        self.downloader_kwargs = downloader_kwargs
+        self.downloaders = {}
+        self.emitted_ids = {}
+        self.gap_polls = {}
+        self.state_lock = threading.Lock()
+        self.newest_ids = self.load_state()
+        self.stopped = threading.Event()
+
+    def load_state(self):
+        if self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return {uid: int(post_id) for uid, post_id in json.load(f).items()}
+        return {}
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump(self.newest_ids, f, indent=4)
+
+    def get_downloader(self, account):
+        if account not in self.downloaders:
+            kind, value = account
+            self.downloaders[account] = _WatchedWeiboDownloader(
+                **{kind: value}, **self.downloader_kwargs
+            )
+        return self.downloaders[account]
+
+    def fetch_latest_posts(self, uid):
+        response = requests.get(
+            url=self.timeline_api_url,
+            params={"type": "uid", "value": uid, "containerid": "107603" + str(uid)},
+            timeout=self.request_timeout,
+        )
+        latest = []
+        for card in response.json()["data"]["cards"]:
+            mblog = card.get("mblog")
+            # Pinned posts are old posts at the head, they say nothing new.
+            if card.get("card_type") == 9 and mblog and not mblog.get("isTop"):
+                latest.append(
+                    {"id": int(mblog["id"]), "created_at": mblog.get("created_at")}
+                )
+        return latest
+
+    def parse_created_at(self, downloader, created_at):
+        try:
+            # Page times are parsed in the host's local time, so convert the
+            # API's Beijing time to it rather than dropping the offset.
+            created_at = datetime.strptime(created_at, "%a %b %d %H:%M:%S %z %Y")
+            return created_at.astimezone().replace(tzinfo=None)
+        except (TypeError, ValueError):
+            pass
+        try:
+            return downloader.parse_time(created_at)
+        except Exception:
+            return None
+
+    def get_post_id(self, post):
+        if "mblog" in post:
+            post_id = post["mblog"].get("id")
+        else:
+            post_id = post["url"].split("/")[-1] if post["url"] else None
+        return int(post_id) if post_id and str(post_id).isdigit() else None
+
+    def check_account(self, account):
+        downloader = self.get_downloader(account)
+        uid = str(downloader.uid)
+        latest = self.fetch_latest_posts(uid)
+        if not latest:
+            return []
+        newest_id = max(post["id"] for post in latest)
+        known_id = self.newest_ids.get(uid)
+        if known_id is None and not self.emit_existing:
+            # First sight of this account, remember where its timeline is.
+            with self.state_lock:
+                self.newest_ids[uid] = newest_id
+                self.save_state()
+            return []
+        new_posts = [
+            post for post in latest if known_id is None or post["id"] > known_id
+        ]
+        if not new_posts:
+            return []
+        posts = self.extract_new_posts(downloader, new_posts)
+        # Posts above a gap may be returned again on the next poll.
+        emitted_ids = self.emitted_ids.setdefault(uid, set())
+        posts = [post for post in posts if self.get_post_id(post) not in emitted_ids]
+        emitted_ids.update(
+            post_id for post_id in map(self.get_post_id, posts) if post_id
+        )
+        with self.state_lock:
+            # Only move past posts that were actually extracted. A post the
+            # page has not rendered yet stays new until a later poll finds it.
+            for post_id in sorted(post["id"] for post in new_posts):
+                if post_id not in emitted_ids:
+                    break
+                self.newest_ids[uid] = max(post_id, self.newest_ids.get(uid) or 0)
+            reached_id = self.newest_ids.get(uid)
+            if reached_id != known_id or (reached_id or 0) >= newest_id:
+                # Caught up, or moved past a gap since the previous poll.
+                self.gap_polls.pop(uid, None)
+            else:
+                self.gap_polls[uid] = self.gap_polls.get(uid, 0) + 1
+                if self.gap_polls[uid] >= self.max_gap_polls:
+                    # A post listed by the API but never shown on the page,
+                    # e.g. deleted or hidden since, would otherwise open a
+                    # browser on every poll.
+                    print(
+                        "[Warning] Skipping posts of {} up to {} not found on "
+                        "the page after {} polls.".format(
+                            uid, newest_id, self.gap_polls.pop(uid)
+                        )
+                    )
+                    self.newest_ids[uid] = newest_id
+            self.save_state()
+        emitted_ids.difference_update(
+            [
+                post_id
+                for post_id in emitted_ids
+                if post_id <= (self.newest_ids.get(uid) or 0)
+            ]
+        )
+        return posts
+
+    def extract_new_posts(self, downloader, new_posts):
+        new_ids = set(post["id"] for post in new_posts)
+        times = [
+            self.parse_created_at(downloader, post["created_at"]) for post in new_posts
+        ]
+        if all(times):
+            # Relative times such as "n小时前" are rounded, leave an hour of
+            # slack and rely on the post IDs for the exact cut.
+            downloader.since = str(min(times) - timedelta(hours=1))
+        else:
+            downloader.since = None
+        with self.browser_slots:
+            try:
+                posts = list(downloader.run_generator(yield_data=True))
+            except Exception:
+                # A long-running watch must not leak a browser per failure.
+                downloader.close_if_open()
+                raise
+        # Posts without an ID cannot be told apart between polls, they are
+        # left to a later poll that resolves their url.
+        return [post for post in posts if self.get_post_id(post) in new_ids]
+
+    def schedule(self, now):
+        # Offsets spread the first polls evenly over one interval, so hundreds
+        # of accounts do not all hit the endpoint in the same second.
+        heap = []
+        for i in range(len(self.accounts)):
+            slot = now + i * self.interval / len(self.accounts)
+            heap.append((slot, slot, i))
+        heapq.heapify(heap)
+        return heap
+
+    def next_run(self, slot, now):
+        slot += self.interval
+        if slot < now:
+            # The account fell behind, skip the missed polls instead of bursting.
+            slot = now
+        return slot + random.uniform(0, self.jitter * self.interval), slot
+
+    def run_generator(self):
+        self.stopped.clear()
+        heap = self.schedule(time.time())
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while not self.stopped.is_set():
+                now = time.time()
+                while (
+                    heap and heap[0][0] <= now and len(running) < self.max_concurrency
+                ):
+                    _, slot, i = heapq.heappop(heap)
+                    future = executor.submit(self.check_account, self.accounts[i])
+                    running[future] = (slot, i)
+                timeout = (
+                    max(0, heap[0][0] - time.time())
+                    if heap and len(running) < self.max_concurrency
+                    else None
+                )
+                if running:
+                    done, _ = wait(
+                        running, timeout=timeout, return_when=FIRST_COMPLETED
+                    )
+                else:
+                    self.stopped.wait(timeout)
+                    done = ()
+                for future in done:
+                    slot, i = running.pop(future)
+                    heapq.heappush(heap, self.next_run(slot, time.time()) + (i,))
+                    try:
+                        posts = future.result()
+                    except Exception as e:
+                        print(
+                            "[Error] Failed to check {}: {}".format(
+                                self.accounts[i][1], e
+                            )
+                        )
+                        continue
+                    for post in posts:
+                        if self.on_post:
+                            self.on_post(post)
+                        yield post
+
+    def run(self):
+        # Consumes the generator, posts are delivered through on_post
+        for _ in self.run_generator():
+            pass
+
+    def stop(self):
+        self.stopped.set()
@@ -6,13 +6,61 @@ import re
 from urllib import request, parse
 import requests
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.chrome.options import Options
 from datetime import datetime, timedelta
 from webdriver_manager.chrome import ChromeDriverManager
-
+from .cache import DetailCache, VIDEO_LINK_TTL
+
+
+# Finds the page_info (stream urls per quality) of each card given in
+# arguments[0], in the Vue components of the card and its descendants. Parent
+# components are skipped, as the timeline list holds every card's data.
+VIDEO_PAGE_INFO_SCRIPT = """
+function findPageInfo(value, depth, seen) {
+    if (!value || typeof value !== "object" || depth > 4 || seen.has(value)) {
+        return null;
+    }
+    seen.add(value);
+    if (value.page_info && (value.page_info.urls || value.page_info.media_info)) {
+        return value.page_info;
+    }
+    for (var key in value) {
+        if (key.charAt(0) === "$" || key.charAt(0) === "_") {
+            continue;
+        }
+        var found = findPageInfo(value[key], depth + 1, seen);
+        if (found) {
+            return found;
+        }
+    }
+    return null;
+}
+return arguments[0].map(function (card) {
+    var nodes = [card].concat(Array.prototype.slice.call(card.querySelectorAll("*")));
+    for (var i = 0; i < nodes.length; i++) {
+        var vm = nodes[i].__vue__;
+        if (!vm) {
+            continue;
+        }
+        var pageInfo = findPageInfo(vm.$props, 0, new Set())
+            || findPageInfo(vm.$data, 0, new Set());
+        if (pageInfo) {
+            return {
+                urls: pageInfo.urls || null,
+                media_info: pageInfo.media_info ? {
+                    stream_url: pageInfo.media_info.stream_url || null,
+                    stream_url_hd: pageInfo.media_info.stream_url_hd || null,
+                } : null,
+            };
+        }
+    }
+    return null;
+});
+"""
 
 
 class WeiboDownloader:
@@ -35,11 +83,16 @@ class WeiboDownloader:
         date_to=None,
         pages=None,
         weibo_timeline_url_prefix="https://m.weibo.cn/u/",
+        cache=None,
+        enable_lightweight_browser=False,
+        enable_batch_video_links=True,
+        video_quality_preference=None,
     ):
         if not uid and not username:
             raise ValueError("Either uid or username must be specified.")
         if uid and username:
             raise ValueError("Only one of uid or username can be specified.")
+        self.cache = DetailCache(cache) if isinstance(cache, str) else cache
         self.username = username
         self.uid = uid if uid else self.get_uid_from_username(username)
         self.save_path_csv = save_path_csv
@@ -62,6 +115,13 @@ class WeiboDownloader:
                 "for they are mutually exclusive."
             )
         self.enable_get_video_links = enable_get_video_links
+        self.enable_batch_video_links = enable_batch_video_links
+        self.video_quality_preference = video_quality_preference or [
+            "mp4_1080p_mp4",
+            "mp4_720p_mp4",
+            "mp4_hd_mp4",
+            "mp4_ld_mp4",
+        ]
         self.enable_get_urls = enable_get_urls
         self.enable_fill_truncated_texts = enable_fill_truncated_texts
         self.date_from = self.filter_date_format(date_from) if date_from else None
@@ -73,6 +133,8 @@ class WeiboDownloader:
                 "specified. Please remove date range options or pages option."
             )
         self.weibo_timeline_url_prefix = weibo_timeline_url_prefix
+        self.enable_lightweight_browser = enable_lightweight_browser
+        self.browser_stage = None
         self.dinstict_class_names = {
             "post-whole-card": "card9",
             "weibo-text": "weibo-text",
@@ -86,6 +148,28 @@ class WeiboDownloader:
             "indicator-back-to-main-page": "overlay",
             "indicator-enter-expand-page": "lite-page-tab",
         }
+        # URL patterns blocked by the lightweight browser, by category. Full
+        # size media is fetched by download_media, not by the browser.
+        self.blocked_url_patterns = {
+            "image": ["*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*", "*.bmp*"],
+            "media": ["*.mp4*", "*.m3u8*", "*.flv*", "*.mov*"],
+            "font": ["*.woff*", "*.ttf*", "*.otf*", "*.eot*"],
+            "tracking": [
+                "*google-analytics.com*",
+                "*googletagmanager.com*",
+                "*hm.baidu.com*",
+                "*.cnzz.com*",
+                "*.umeng.com*",
+                "*beacon.sina.com.cn*",
+            ],
+        }
+        # Categories blocked in each stage of scraping. The video stage keeps
+        # media requests, as the player needs them to expose the stream.
+        self.lightweight_browser_stages = {
+            "timeline": ["image", "media", "font", "tracking"],
+            "video": ["image", "font", "tracking"],
+            "expand": ["image", "media", "font", "tracking"],
+        }
         self.date_from_stored = None
         self.date_to_stored = None
         self.card_hashes = set()
@@ -94,6 +178,10 @@ class WeiboDownloader:
         self.posts_in_api_format = []
 
     def get_uid_from_username(self, username):
+        if self.cache is not None:
+            uid = self.cache.get("uid", username)
+            if uid:
+                return uid
         try:
             params = {
                 "queryVal": username,
@@ -102,7 +190,7 @@ class WeiboDownloader:
             response = requests.get(
                 url="https://m.weibo.cn/api/container/getIndex", params=params
             )
-            return int(
+            uid = int(
                 response.json()["data"]["cards"][1]["card_group"][0]["user"]["id"]
             )
         except Exception as e:
@@ -111,6 +199,9 @@ class WeiboDownloader:
                 "use UID instead of username."
             )
             raise e
+        if self.cache is not None:
+            self.cache.set("uid", username, uid)
+        return uid
 
     def filter_date_format(self, date):
         try:
@@ -122,17 +213,60 @@ class WeiboDownloader:
         text = element.text
         return hashlib.md5(text.encode()).hexdigest()
 
+    def generate_cache_key(self, post):
+        # Only fields that stay the same between runs: the card hash includes
+        # like/comment counts, and times such as "n分钟前" are parsed relative
+        # to now. Image urls carry pids that are unique per picture.
+        text = "\n".join(
+            [str(post["uid"]), post["text"]] + post["images"] + post["links"]
+        )
+        return hashlib.md5(text.encode()).hexdigest()
+
+    def get_cached_details(self, namespace, post):
+        if self.cache is None:
+            return None
+        cached = self.cache.get(namespace, self.generate_cache_key(post))
+        if not cached:
+            return None
+        # Posts without images that share their text, such as "转发微博"
+        # reposts, share a key too. Their times tell them apart, with a day of
+        # slack for relative times and dates shown without hh:mm.
+        try:
+            delta = datetime.strptime(
+                cached["time"], "%Y-%m-%d %H:%M:%S"
+            ) - datetime.strptime(post["time"], "%Y-%m-%d %H:%M:%S")
+        except (KeyError, TypeError, ValueError):
+            return None
+        if abs(delta) > timedelta(days=1):
+            return None
+        return cached["details"]
+
+    def set_cached_details(self, namespace, post, details, ttl=None):
+        if self.cache is not None:
+            self.cache.set(
+                namespace,
+                self.generate_cache_key(post),
+                {"time": post["time"], "details": details},
+                ttl=ttl,
+            )
+
     def prepare_webdriver(self):
         chrome_options = Options()
         chrome_options.add_argument("--log-level=3")
         chrome_options.add_argument("--headless")
         chrome_options.add_argument("--disable-gpu")
         chrome_options.add_argument("--mute-audio")
+        if self.enable_lightweight_browser:
+            chrome_options.add_argument("--autoplay-policy=user-gesture-required")
         try:
             self.driver = webdriver.Chrome(options=chrome_options)
         except:
             self.driver = webdriver.Chrome(ChromeDriverManager().install())
         self.wait = WebDriverWait(self.driver, 30)
+        self.browser_stage = None
+        if self.enable_lightweight_browser:
+            self.driver.execute_cdp_cmd("Network.enable", {})
+            self.set_browser_stage("timeline")
         self.driver.get(self.weibo_timeline_url_prefix + str(self.uid))
         self.wait.until(
             lambda driver: driver.find_element(
@@ -140,6 +274,19 @@ class WeiboDownloader:
             )
         )
 
+    def set_browser_stage(self, stage):
+        """
+        Block the URL categories listed for the stage in
+        self.lightweight_browser_stages, if the lightweight browser is enabled.
+        """
+        if not self.enable_lightweight_browser or stage == self.browser_stage:
+            return
+        patterns = []
+        for category in self.lightweight_browser_stages[stage]:
+            patterns.extend(self.blocked_url_patterns[category])
+        self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+        self.browser_stage = stage
+
     def run(self, yield_data=False):
         # Consumes the generator to get all data
         for _ in self.run_generator(yield_data):
@@ -163,19 +310,16 @@ class WeiboDownloader:
                     not self.date_from_stored or self.date_from_stored >= self.date_from
                 )
             ):
-                if self.pages > 0:
+                if self.pages:
                     page_count += 1
                 if self.verbose:
                     print("Getting more posts with new scroll...")
                 self.scroll_to_bottom()
-                self.wait.until(
-                    lambda driver: len(
-                        driver.find_elements(
-                            By.CLASS_NAME, self.dinstict_class_names["post-whole-card"]
-                        )
-                    )
-                    > len(self.posts)
-                )
+                if not self.wait_for_new_cards():
+                    if self.verbose:
+                        print("Reached the end of the timeline.")
+                    break
+                card_count = len(self.card_hashes)
                 try:
                     new_posts = self.fetch_more_posts()
                 except:
@@ -183,9 +327,10 @@ class WeiboDownloader:
                 if not self.enable_simplified_json:
                     new_posts_in_api_format = self.get_posts_in_api_format(new_posts)
                     self.posts_in_api_format.extend(new_posts_in_api_format)
-                if not new_posts:
-                    # If no new posts are found, it means we don't have posts
-                    # within the date range. Break the loop.
+                if not new_posts and len(self.card_hashes) == card_count:
+                    # If no new cards are found, it means the timeline has no
+                    # more posts. Break the loop. Cards newer than date_to are
+                    # new cards without posts, so keep scrolling past them.
                     break
                 self.posts.extend(new_posts)
                 new_ticktok = time.time()
@@ -243,6 +388,35 @@ class WeiboDownloader:
     def scroll_to_bottom(self):
         self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
 
+    def wait_for_new_cards(self):
+        """
+        Wait for new cards after a scroll. Returns False at the end of the
+        timeline, and raises TimeoutException if the page stalled instead.
+        """
+
+        def count_cards():
+            return len(
+                self.driver.find_elements(
+                    By.CLASS_NAME, self.dinstict_class_names["post-whole-card"]
+                )
+            )
+
+        try:
+            self.wait.until(lambda driver: count_cards() > len(self.card_hashes))
+            return True
+        except TimeoutException:
+            card_count = count_cards()
+        # A slow or throttled page times out too, so scroll once more and only
+        # take it as the end if the cards on the page stayed the same.
+        self.scroll_to_bottom()
+        try:
+            self.wait.until(lambda driver: count_cards() > len(self.card_hashes))
+            return True
+        except TimeoutException:
+            if count_cards() != card_count:
+                raise
+            return False
+
     def fetch_more_posts(self):
         card_mains = self.driver.find_elements(
             By.CLASS_NAME, self.dinstict_class_names["post-whole-card"]
@@ -257,7 +431,7 @@ class WeiboDownloader:
                 and self.date_from
                 and self.date_from_stored < self.date_from
             ):
-                return
+                break
             post_data = self.extract_post_data(card_main)
             if post_data:
                 new_posts.append(post_data)
@@ -265,21 +439,25 @@ class WeiboDownloader:
         if self.enable_get_video_links:
             if self.verbose:
                 print("  *Getting video links...")
+            self.set_browser_stage("video")
             self.get_video_links(new_posts)
             if self.verbose:
                 print("  *Finished getting video links!")
         if self.enable_fill_truncated_texts:
             if self.verbose:
                 print("  *Filling truncated texts...")
+            self.set_browser_stage("expand")
             self.fill_truncated_texts(new_posts)
             if self.verbose:
                 print("  *Finished filling truncated texts!")
         if self.enable_get_urls:
             if self.verbose:
                 print("  *Getting urls...")
+            self.set_browser_stage("expand")
             self.get_urls(new_posts)
             if self.verbose:
                 print("  *Finished getting urls!")
+        self.set_browser_stage("timeline")
         self.download_media(new_posts)
         # self.posts.extend(new_posts)
         return new_posts
@@ -298,7 +476,7 @@ class WeiboDownloader:
             self.date_to_stored = post_time.date()
         if self.date_from and post_time.date() < self.date_from:
             return None
-        if self.date_to and post_time > self.date_to:
+        if self.date_to and post_time.date() > self.date_to:
             return None
         # Get card hash, and skip if already exists from previous scroll
         card_hash = self.generate_hash(card_main)
@@ -367,56 +545,132 @@ class WeiboDownloader:
         return post_data
 
     def get_video_links(self, posts):
+        video_posts = []
         for post in posts:
             if "video_hash" in post["tracking_params"]:
-                card_videos = self.driver.find_elements(
-                    By.CLASS_NAME, self.dinstict_class_names["post-video-main-page"]
-                )
-                for card_video in card_videos:
-                    if (
-                        self.generate_hash(card_video)
-                        == post["tracking_params"]["video_hash"]
-                    ):
-                        self.click(card_video)
-                        self.wait.until(
-                            lambda driver: driver.find_element(
-                                By.CLASS_NAME,
-                                self.dinstict_class_names["video-page-menu-item"],
-                            )
-                        )
-                        all_quality_lis = self.driver.find_elements(
+                cached = self.get_cached_details("video", post)
+                if cached:
+                    post["video"] = cached["video"]
+                    if cached.get("video_urls"):
+                        post["tracking_params"]["video_urls"] = cached["video_urls"]
+                    continue
+                video_posts.append(post)
+        if self.enable_batch_video_links:
+            video_posts = self.get_video_links_in_batch(video_posts)
+        # Only the videos that page data did not resolve go through the player.
+        for post in video_posts:
+            card_videos = self.driver.find_elements(
+                By.CLASS_NAME, self.dinstict_class_names["post-video-main-page"]
+            )
+            for card_video in card_videos:
+                if (
+                    self.generate_hash(card_video)
+                    == post["tracking_params"]["video_hash"]
+                ):
+                    self.click(card_video)
+                    self.wait.until(
+                        lambda driver: driver.find_element(
                             By.CLASS_NAME,
                             self.dinstict_class_names["video-page-menu-item"],
                         )
-                        highest_quality_li = all_quality_lis[0]
-                        self.driver.execute_script(
-                            "arguments[0].click();", highest_quality_li
-                        )
-                        self.wait.until(
-                            lambda driver: driver.find_element(
-                                By.CLASS_NAME,
-                                self.dinstict_class_names["video-page-video"],
-                            )
-                        )
-                        video = self.driver.find_element(
-                            By.CLASS_NAME, self.dinstict_class_names["video-page-video"]
-                        )
-                        video_link = video.get_attribute("src")
-                        post["video"] = video_link
-                        dispose_player = self.driver.find_element(
+                    )
+                    all_quality_lis = self.driver.find_elements(
+                        By.CLASS_NAME,
+                        self.dinstict_class_names["video-page-menu-item"],
+                    )
+                    highest_quality_li = all_quality_lis[0]
+                    self.driver.execute_script(
+                        "arguments[0].click();", highest_quality_li
+                    )
+                    self.wait.until(
+                        lambda driver: driver.find_element(
                             By.CLASS_NAME,
-                            self.dinstict_class_names["video-page-back-button"],
+                            self.dinstict_class_names["video-page-video"],
                         )
-                        self.click(dispose_player)
+                    )
+                    video = self.driver.find_element(
+                        By.CLASS_NAME, self.dinstict_class_names["video-page-video"]
+                    )
+                    video_link = video.get_attribute("src")
+                    post["video"] = video_link
+                    self.set_cached_details(
+                        "video", post, {"video": video_link}, ttl=VIDEO_LINK_TTL
+                    )
+                    dispose_player = self.driver.find_element(
+                        By.CLASS_NAME,
+                        self.dinstict_class_names["video-page-back-button"],
+                    )
+                    self.click(dispose_player)
         return posts
 
+    def get_video_links_in_batch(self, posts):
+        """
+        Read the stream urls of all videos from the page data of their cards
+        with a single script call, instead of opening the player for each.
+        Returns the posts whose videos could not be resolved this way.
+        """
+        if not posts:
+            return posts
+        card_mains = self.driver.find_elements(
+            By.CLASS_NAME, self.dinstict_class_names["post-whole-card"]
+        )
+        try:
+            page_infos = self.driver.execute_script(VIDEO_PAGE_INFO_SCRIPT, card_mains)
+        except Exception:
+            return posts
+        card_indices = {}
+        for i in range(len(card_mains)):
+            card_indices.setdefault(self.generate_hash(card_mains[i]), i)
+        unresolved = []
+        for post in posts:
+            i = card_indices.get(post["tracking_params"]["hash"])
+            video_urls = self.get_video_urls_from_page_info(
+                page_infos[i] if i is not None and i < len(page_infos) else None
+            )
+            if not video_urls:
+                unresolved.append(post)
+                continue
+            post["video"] = self.choose_video_url(video_urls)
+            post["tracking_params"]["video_urls"] = video_urls
+            self.set_cached_details(
+                "video",
+                post,
+                {"video": post["video"], "video_urls": video_urls},
+                ttl=VIDEO_LINK_TTL,
+            )
+        return unresolved
+
+    def get_video_urls_from_page_info(self, page_info):
+        if not page_info:
+            return {}
+        video_urls = {
+            quality: url
+            for quality, url in (page_info.get("urls") or {}).items()
+            if isinstance(url, str) and url
+        }
+        if not video_urls:
+            media_info = page_info.get("media_info") or {}
+            if media_info.get("stream_url_hd"):
+                video_urls["mp4_hd_mp4"] = media_info["stream_url_hd"]
+            if media_info.get("stream_url"):
+                video_urls["mp4_ld_mp4"] = media_info["stream_url"]
+        return video_urls
+
+    def choose_video_url(self, video_urls):
+        for quality in self.video_quality_preference:
+            if quality in video_urls:
+                return video_urls[quality]
+        return next(iter(video_urls.values()))
+
     def fill_truncated_texts(self, posts):
         for post in posts:
             if post["tracking_params"]["is_text_truncated"]:
-                expand_post = self.extract_post_data_from_expand(post)
+                expand_post = self.get_expanded_post(post)
                 if expand_post:
                     for attr in expand_post:
-                        if attr != "video":
+                        # tracking_params stay those of the timeline card, as
+                        # they hold the video urls resolved from it.
+                        if attr not in ("video", "tracking_params"):
                             if not post[attr] or post[attr] != expand_post[attr]:
                                 post[attr] = expand_post[attr]
                     post["tracking_params"]["is_text_truncated"] = False
@@ -425,14 +679,30 @@ class WeiboDownloader:
     def get_urls(self, posts):
         for post in posts:
             if not post["url"]:
-                expand_post = self.extract_post_data_from_expand(post)
+                expand_post = self.get_expanded_post(post)
                 if expand_post:
                     for attr in expand_post:
-                        if attr != "video":
+                        # tracking_params stay those of the timeline card, as
+                        # they hold the video urls resolved from it.
+                        if attr not in ("video", "tracking_params"):
                             if not post[attr] or post[attr] != expand_post[attr]:
                                 post[attr] = expand_post[attr]
         return posts
 
+    def get_expanded_post(self, post):
+        if self.cache is None:
+            return self.extract_post_data_from_expand(post)
+        details = self.get_cached_details("detail", post)
+        if details:
+            return details
+        expand_post = self.extract_post_data_from_expand(post)
+        if expand_post:
+            # Only the details found on the expand page, other fields of a
+            # cached post would overwrite the ones of the current run.
+            details = {attr: expand_post[attr] for attr in ("text", "url", "links")}
+            self.set_cached_details("detail", post, details)
+        return expand_post
+
     def scroll_to(self, element):
         self.driver.execute_script(
             "arguments[0].scrollIntoView({block: 'center', inline: 'nearest'});",
@@ -652,11 +922,15 @@ class WeiboDownloader:
     def get_posts_in_api_format(self, posts):
         ret = []
         for post in posts:
-            video_attr_name = (
-                parse.parse_qs(parse.urlparse(post["video"]).query)["label"][0] + "_mp4"
+            video_urls = post["tracking_params"].get("video_urls")
+            video_labels = (
+                parse.parse_qs(parse.urlparse(post["video"]).query).get("label")
                 if post["video"]
                 else None
             )
+            video_attr_name = (
+                video_labels[0] + "_mp4" if video_labels else "stream_url"
+            )
             ret.append(
                 {
                     "scheme": post["url"],
@@ -680,7 +954,9 @@ class WeiboDownloader:
                     },
                 }
             )
-            if post["video"]:
+            if video_urls:
+                ret[-1]["mblog"]["page_info"]["urls"].update(video_urls)
+            elif post["video"]:
                 ret[-1]["mblog"]["page_info"]["urls"][video_attr_name] = post["video"]
         ret = self.remove_empty_attrs(ret)
         return ret
@@ -688,6 +964,15 @@ class WeiboDownloader:
     def close(self):
         self.driver.quit()
 
+    def close_if_open(self):
+        # Cleanup after a failure, when the browser may never have started or
+        # may already be gone.
+        if hasattr(self, "driver"):
+            try:
+                self.driver.quit()
+            except Exception:
+                pass
+
 
 def get_weibo_posts_by_name(
     username="来去之间",
@@ -707,6 +992,10 @@ def get_weibo_posts_by_name(
     date_to=None,
     pages=None,
     weibo_timeline_url_prefix="https://m.weibo.cn/u/",
+    cache=None,
+    enable_lightweight_browser=False,
+    enable_batch_video_links=True,
+    video_quality_preference=None,
 ):
     weibo_downloader = WeiboDownloader(
         username=username,
@@ -726,5 +1015,9 @@ def get_weibo_posts_by_name(
         date_to=date_to,
         pages=pages,
         weibo_timeline_url_prefix=weibo_timeline_url_prefix,
+        cache=cache,
+        enable_lightweight_browser=enable_lightweight_browser,
+        enable_batch_video_links=enable_batch_video_links,
+        video_quality_preference=video_quality_preference,
     )
     return weibo_downloader.get_weibo_posts_by_name(username)